@@ -1,17 +1,23 @@
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import HTMLResponse, FileResponse
+from fastapi import FastAPI, HTTPException, Depends, Request, Query, BackgroundTasks
+from fastapi.responses import FileResponse, Response
 from fastapi.staticfiles import StaticFiles
+from fastapi.middleware.gzip import GZipMiddleware
 from pydantic import BaseModel
 import os
-import datetime
+import time
+import asyncio
+import aiofiles.os
 import gdown
 import shutil
 import magic
 import uuid
+import hashlib
 import logging
+import orjson
+from collections import OrderedDict
+from urllib.parse import quote
 from dotenv import load_dotenv
-import psycopg2
-from psycopg2.extras import RealDictCursor
+import asyncpg
 
 # Load environment variables
 load_dotenv()
@@ -21,191 +27,371 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 app = FastAPI()
+app.add_middleware(GZipMiddleware, minimum_size=500)
 
 # Ensure storage folder exists BEFORE mounting
 if not os.path.exists("storage"):
     os.makedirs("storage")
 app.mount("/storage", StaticFiles(directory="storage"), name="storage")
 
-# DB connection
-def get_db_connection():
+# DB connection pool (one per process, created at startup)
+@app.on_event("startup")
+async def create_db_pool():
     try:
-        conn = psycopg2.connect(os.environ["DATABASE_URL"], cursor_factory=RealDictCursor)
-        return conn
+        app.state.pool = await asyncpg.create_pool(
+            os.environ["DATABASE_URL"],
+            min_size=5,
+            max_size=20,
+            timeout=30,
+            # Prepared statements are cached per connection, so hot lookups are parsed once
+            statement_cache_size=1024,
+            init=lambda c: c.execute("SELECT 1"),
+        )
     except Exception as e:
         logger.error(f"PostgreSQL connection failed: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"PostgreSQL connection failed: {str(e)}")
-
-# Create images table if not exists
-conn = get_db_connection()
-cursor = conn.cursor()
-cursor.execute("""
-CREATE TABLE IF NOT EXISTS images (
-    id TEXT PRIMARY KEY,
-    name TEXT,
-    google_drive_id TEXT,
-    size BIGINT,
-    mime_type TEXT,
-    storage_path TEXT,
-    imported_at TIMESTAMP
-)
-""")
-conn.commit()
-cursor.close()
-conn.close()
+        raise
+
+    # Create images table if not exists
+    async with app.state.pool.acquire() as conn:
+        await conn.execute("""
+        CREATE TABLE IF NOT EXISTS images (
+            id TEXT PRIMARY KEY,
+            name TEXT,
+            google_drive_id TEXT,
+            size BIGINT,
+            mime_type TEXT,
+            storage_path TEXT,
+            imported_at TIMESTAMPTZ NOT NULL DEFAULT clock_timestamp(),
+            content_sha TEXT
+        )
+        """)
+        await conn.execute("ALTER TABLE images ADD COLUMN IF NOT EXISTS content_sha TEXT")
+        # Bring tables created before imported_at became TIMESTAMPTZ in line with the DDL above
+        imported_at_type = await conn.fetchval("""
+            SELECT data_type FROM information_schema.columns
+            WHERE table_schema = current_schema() AND table_name = 'images' AND column_name = 'imported_at'
+        """)
+        if imported_at_type != "timestamp with time zone":
+            await conn.execute("""
+            ALTER TABLE images
+                ALTER COLUMN imported_at TYPE TIMESTAMPTZ
+                    USING COALESCE(imported_at AT TIME ZONE 'UTC', clock_timestamp()),
+                ALTER COLUMN imported_at SET DEFAULT clock_timestamp(),
+                ALTER COLUMN imported_at SET NOT NULL
+            """)
+        await conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_images_content_sha ON images (content_sha)")
+        await conn.execute("DROP INDEX IF EXISTS idx_images_imported_at")
+        await conn.execute("CREATE INDEX IF NOT EXISTS idx_images_imported_at_id ON images (imported_at DESC, id DESC)")
+
+@app.on_event("shutdown")
+async def close_db_pool():
+    await app.state.pool.close()
+
+# Borrow a pooled connection for a request handler, failing fast if the pool is exhausted
+async def acquire_conn(pool):
+    try:
+        return await pool.acquire(timeout=2.0)
+    except Exception as e:
+        # Pool timeouts carry no message, so fall back to the exception type
+        reason = str(e) or type(e).__name__
+        logger.error(f"PostgreSQL connection failed: {reason}")
+        raise HTTPException(status_code=500, detail=f"PostgreSQL connection failed: {reason}")
+
+# Per-request connection, released back to the pool when the response is done
+async def get_conn(request: Request):
+    conn = await acquire_conn(request.app.state.pool)
+    try:
+        yield conn
+    finally:
+        await request.app.state.pool.release(conn)
+
+# Rows buffered in memory before being flushed to the DB during an import
+BULK_BATCH_SIZE = 500
+# Concurrent workers processing downloaded files during an import
+IMPORT_WORKERS = 5
+# Concurrent Google Drive file downloads per import
+DOWNLOAD_CONCURRENCY = 8
+# Bulk insert of row tuples built by process_file; content already stored is skipped
+INSERT_IMAGES_SQL = """
+    INSERT INTO images (id, name, google_drive_id, size, mime_type, storage_path, content_sha)
+    SELECT * FROM unnest($1::text[], $2::text[], $3::text[], $4::bigint[], $5::text[], $6::text[], $7::text[])
+    ON CONFLICT (content_sha) DO NOTHING
+    RETURNING id
+"""
+HASH_CHUNK_SIZE = 1 << 20
+# Importable extensions and the MIME types they should sniff as
+EXT_MIME = {".jpg": "image/jpeg", ".jpeg": "image/jpeg", ".png": "image/png", ".gif": "image/gif"}
+VALID_EXT = frozenset(EXT_MIME)
+MIME_SNIFF_SIZE = 4096
+
+# In-process LRU+TTL cache of /images pages keyed by (limit, offset), cleared by import_images
+IMAGES_CACHE_TTL = 30
+IMAGES_CACHE_MAX_PAGES = 128
+_images_cache = {"pages": OrderedDict(), "version": 0}
+
+def invalidate_images_cache():
+    _images_cache["pages"].clear()
+    _images_cache["version"] += 1
+
+# Import jobs by id, polled by the frontend (in-process, like the listing cache)
+IMPORT_JOBS_MAX = 100
+import_jobs = {}
+
+# Forget the oldest finished jobs to make room for a new one
+def prune_import_jobs():
+    finished = [job_id for job_id, job in import_jobs.items() if job["status"] != "running"]
+    for job_id in finished[:max(0, len(import_jobs) - IMPORT_JOBS_MAX + 1)]:
+        del import_jobs[job_id]
 
 # Request model
 class ImportRequest(BaseModel):
     url: str
 
-# Import images
-@app.post("/import")
-async def import_images(req: ImportRequest):
-    conn = get_db_connection()
-    cursor = conn.cursor()
+# Insert a batch of image rows in one statement and return the ids actually inserted
+async def insert_image_rows(pool, rows):
+    async with pool.acquire() as conn:
+        inserted = await conn.fetch(INSERT_IMAGES_SQL, *zip(*rows))
+    return {row["id"] for row in inserted}
+
+# Read a file once: sniff its MIME type from the first block, then hash the rest.
+# Returns (mime_type, content_sha, size); content_sha is None for non-images.
+def sniff_and_hash(path):
+    with open(path, 'rb') as f:
+        head = f.read(MIME_SNIFF_SIZE)
+        mime_type = magic.from_buffer(head, mime=True)
+        if not mime_type.startswith('image/'):
+            return mime_type, None, len(head)
+        h = hashlib.sha256(head)
+        size = len(head)
+        while chunk := f.read(HASH_CHUNK_SIZE):
+            h.update(chunk)
+            size += len(chunk)
+    return mime_type, h.hexdigest(), size
+
+# Download one Drive file from the folder manifest to local_path; returns it (None on failure)
+async def download_file(sem, gdrive_file, local_path):
+    async with sem:
+        try:
+            return await asyncio.to_thread(gdown.download, id=gdrive_file.id, output=local_path, quiet=True)
+        except Exception as e:
+            logger.error(f"Error downloading {gdrive_file.path}: {str(e)}")
+            return None
+
+# Sniff and hash one downloaded file and build its DB row (None if skipped)
+async def process_file(src_path, file, gdrive_id, ext):
+    mime_type, content_sha, file_size = await asyncio.to_thread(sniff_and_hash, src_path)
+    if content_sha is None:
+        logger.info(f"Skipping non-image MIME: {file} ({mime_type})")
+        return None
+    if mime_type != EXT_MIME[ext]:
+        logger.info(f"Extension/content mismatch: {file} is {mime_type}, storing the sniffed type")
+
+    image_id = uuid.uuid4().hex
+    # Shard storage as storage/ab/cd/<id><ext> so no directory grows unbounded
+    dest_path = os.path.join("storage", image_id[:2], image_id[2:4], image_id + ext)
+    return (image_id, file, gdrive_id, file_size, mime_type, dest_path, content_sha)
+
+# Move a batch into storage, then insert it; files whose content was already stored are removed again.
+# A row is only ever committed once its file is in place.
+async def flush_batch(pool, batch):
+    moved = []
+    for row, src_path in batch:
+        file, dest_path = row[1], row[5]
+        try:
+            await aiofiles.os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+            logger.info(f"Moving {file} -> {dest_path}")
+            await asyncio.to_thread(shutil.move, src_path, dest_path)
+            moved.append(row)
+        except Exception as e:
+            logger.error(f"Error processing {file}: {str(e)}")
+    if not moved:
+        return 0
+
+    # If the insert fails its files stay in storage: a failed round-trip may still have committed,
+    # and an unreferenced file is harmless where a row without its file is not
+    inserted = await insert_image_rows(pool, moved)
+    for row in moved:
+        if row[0] not in inserted:
+            logger.info(f"Skipping duplicate file: {row[1]}")
+            await remove_stored_file(row[5])
+    return len(inserted)
+
+# Delete a file from storage, ignoring one that is already gone
+async def remove_stored_file(path):
     try:
-        temp_dir = "downloads"
-        if not os.path.exists(temp_dir):
-            os.makedirs(temp_dir)
-
-        logger.info(f"Downloading from {req.url} to {temp_dir}")
-        output = gdown.download_folder(req.url, output=temp_dir, quiet=False, remaining_ok=True)
-
-        if output is None:
-            logger.error("Download failed: Invalid public Google Drive folder URL")
-            raise HTTPException(status_code=400, detail="Invalid public Google Drive folder URL")
-
-        imported_count = 0
-        valid_extensions = ('.jpg', '.png', '.gif', '.jpeg')
-        for root, _, files in os.walk(temp_dir):
-            for file in files:
-                if not file.lower().endswith(valid_extensions):
-                    continue
-                src_path = os.path.join(root, file)
-                dest_path = os.path.join("storage", file)
-                if os.path.exists(dest_path):
-                    logger.info(f"Skipping duplicate file: {file}")
-                    continue
-
-                try:
-                    file_size = os.path.getsize(src_path)
-                    mime_type = magic.from_file(src_path, mime=True)
-                    if not mime_type.startswith('image/'):
-                        logger.info(f"Skipping non-image MIME: {file} ({mime_type})")
-                        continue
-
-                    gdrive_id = file  # placeholder
-                    image_id = str(uuid.uuid4())
-                    logger.info(f"Moving {file} -> {dest_path}")
-                    shutil.move(src_path, dest_path)
-
-                    cursor.execute("""
-                        INSERT INTO images (id, name, google_drive_id, size, mime_type, storage_path, imported_at)
-                        VALUES (%s, %s, %s, %s, %s, %s, %s)
-                    """, (image_id, file, gdrive_id, file_size, mime_type, dest_path, datetime.datetime.now()))
-                    conn.commit()
-                    imported_count += 1
-                except Exception as e:
-                    logger.error(f"Error processing {file}: {str(e)}")
-                    continue
-
-        shutil.rmtree(temp_dir, ignore_errors=True)
-        return {"message": f"Imported {imported_count} images successfully"}
+        await aiofiles.os.remove(path)
+    except FileNotFoundError:
+        pass
+
+# Drain the import queue, flushing this worker's rows in batches
+async def import_worker(queue, pool, job):
+    batch = []
+    while True:
+        try:
+            src_path, file, gdrive_id, ext = queue.get_nowait()
+        except asyncio.QueueEmpty:
+            break
+
+        try:
+            row = await process_file(src_path, file, gdrive_id, ext)
+        except Exception as e:
+            logger.error(f"Error processing {file}: {str(e)}")
+            continue
+        if row is None:
+            continue
+
+        batch.append((row, src_path))
+        if len(batch) >= BULK_BATCH_SIZE:
+            # Not `job["imported"] += await ...`: that reads the counter before other workers update it
+            imported_count = await flush_batch(pool, batch)
+            job["imported"] += imported_count
+            batch = []
+
+    if batch:
+        imported_count = await flush_batch(pool, batch)
+        job["imported"] += imported_count
+
+# Run one import job in the background, recording progress in import_jobs
+async def run_import(job_id, url, pool):
+    job = import_jobs[job_id]
+    temp_dir = os.path.join("downloads", job_id)
+    try:
+        await aiofiles.os.makedirs(temp_dir, exist_ok=True)
+
+        logger.info(f"Listing {url}")
+        files = await asyncio.to_thread(gdown.download_folder, url, output=temp_dir, quiet=True, skip_download=True)
+
+        # Only fetch files that can be images, DOWNLOAD_CONCURRENCY at a time
+        candidates = []
+        for f in files:
+            name = os.path.basename(f.path)
+            ext = os.path.splitext(name)[1].lower()
+            if ext in VALID_EXT:
+                candidates.append((f, name, ext))
+        logger.info(f"Downloading {len(candidates)} files to {temp_dir}")
+        sem = asyncio.Semaphore(DOWNLOAD_CONCURRENCY)
+        # Name downloads by Drive id: a folder may hold several files with the same name
+        local_paths = await asyncio.gather(
+            *(download_file(sem, f, os.path.join(temp_dir, f.id + ext)) for f, _, ext in candidates)
+        )
+
+        queue = asyncio.Queue()
+        for (f, name, ext), local_path in zip(candidates, local_paths):
+            if local_path:
+                queue.put_nowait((local_path, name, f.id, ext))
+
+        workers = [asyncio.create_task(import_worker(queue, pool, job)) for _ in range(IMPORT_WORKERS)]
+        await asyncio.wait(workers, return_when=asyncio.FIRST_EXCEPTION)
+        # If a worker failed, drain the queue so the others stop after the batch they are on.
+        # They are not cancelled: that could interrupt an insert whose outcome is then unknown.
+        while not queue.empty():
+            queue.get_nowait()
+        await asyncio.wait(workers)
+        for worker in workers:
+            if worker.exception():
+                raise worker.exception()
+        job["status"] = "done"
+        job["message"] = f"Imported {job['imported']} images successfully"
 
     except Exception as e:
         logger.error(f"Import error: {str(e)}")
-        raise HTTPException(status_code=500, detail=str(e))
+        job["status"] = "failed"
+        job["error"] = str(e)
     finally:
-        cursor.close()
-        conn.close()
+        invalidate_images_cache()
+        await asyncio.to_thread(shutil.rmtree, temp_dir, ignore_errors=True)
+
+# Import images: start a background job and return its id right away
+@app.post("/import", status_code=202)
+async def import_images(req: ImportRequest, request: Request, background_tasks: BackgroundTasks):
+    prune_import_jobs()
+    job_id = uuid.uuid4().hex
+    import_jobs[job_id] = {"status": "running", "imported": 0}
+    background_tasks.add_task(run_import, job_id, req.url, request.app.state.pool)
+    return {"job_id": job_id}
+
+# Import job status
+@app.get("/import/{job_id}")
+async def get_import_job(job_id: str):
+    job = import_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Import job not found")
+    return job
 
 # List images
 @app.get("/images")
-async def list_images():
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    try:
-        cursor.execute('SELECT * FROM images')
-        rows = cursor.fetchall()
-        return rows
-    finally:
-        cursor.close()
-        conn.close()
+async def list_images(request: Request, limit: int = Query(50, ge=1, le=500), offset: int = Query(0, ge=0)):
+    pages = _images_cache["pages"]
+    key = (limit, offset)
+    page = pages.get(key)
+    if page is None or time.monotonic() >= page["exp"]:
+        version = _images_cache["version"]
+        pool = request.app.state.pool
+        conn = await acquire_conn(pool)
+        try:
+            rows = await conn.fetch("""
+                SELECT id, name, size, mime_type, google_drive_id, imported_at FROM images
+                ORDER BY imported_at DESC, id DESC LIMIT $1 OFFSET $2
+            """, limit, offset)
+        finally:
+            await pool.release(conn)
+        # Serialized once per fill; cache hits send these bytes as-is
+        body = orjson.dumps([dict(row) for row in rows])
+        page = {
+            "body": body,
+            "exp": time.monotonic() + IMAGES_CACHE_TTL,
+            # Content-derived, so it stays valid across restarts and workers
+            "etag": f'"{hashlib.sha256(body).hexdigest()[:16]}"',
+        }
+        # Don't cache a page read while an import was finishing
+        if _images_cache["version"] == version:
+            pages[key] = page
+            if len(pages) > IMAGES_CACHE_MAX_PAGES:
+                pages.popitem(last=False)
+    else:
+        pages.move_to_end(key)
+
+    headers = {"ETag": page["etag"], "Cache-Control": "no-cache"}
+    if request.headers.get("if-none-match") == page["etag"]:
+        return Response(status_code=304, headers=headers)
+    return Response(page["body"], media_type="application/json", headers=headers)
 
 # Get image file
+GET_IMAGE_SQL = 'SELECT name, storage_path, mime_type FROM images WHERE id = $1'
+# Internal nginx location aliased to storage/ (see nginx.conf); unset to stream files from Python
+ACCEL_REDIRECT_PREFIX = os.environ.get("ACCEL_REDIRECT_PREFIX")
+
 @app.get("/image/{image_id}")
-async def get_image(image_id: str):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    try:
-        cursor.execute('SELECT name, storage_path, mime_type FROM images WHERE id = %s', (image_id,))
-        row = cursor.fetchone()
-        if row:
-            return FileResponse(row[1], media_type=row[2], filename=row[0])
-        raise HTTPException(status_code=404, detail="Image not found")
-    finally:
-        cursor.close()
-        conn.close()
+async def get_image(image_id: str, conn=Depends(get_conn)):
+    row = await conn.fetchrow(GET_IMAGE_SQL, image_id)
+    if row:
+        if ACCEL_REDIRECT_PREFIX:
+            rel_path = os.path.relpath(row[1], "storage")
+            return Response(headers={
+                "X-Accel-Redirect": f"{ACCEL_REDIRECT_PREFIX.rstrip('/')}/{quote(rel_path)}",
+                "Content-Type": row[2],
+                "Content-Disposition": f"inline; filename*=utf-8''{quote(row[0])}",
+            })
+        return FileResponse(row[1], media_type=row[2], filename=row[0], content_disposition_type="inline")
+    raise HTTPException(status_code=404, detail="Image not found")
 
 # Frontend
-html_content = """
-<!DOCTYPE html>
-<html>
-<head>
-<title>Image Importer</title>
-<style>
-body { font-family: Arial; background: #f4f4f4; margin: 20px; }
-h1,h2 { color:#333; }
-.form-container { padding:15px; background:#fff; border-radius:8px; box-shadow:0 2px 4px rgba(0,0,0,0.1); margin-bottom:20px; }
-input[type=text] { padding:10px; width:400px; border:1px solid #ccc; border-radius:4px; }
-button { padding:10px 20px; background:#4CAF50; color:white; border:none; border-radius:4px; cursor:pointer; }
-button:hover { background:#45a049; }
-.image-list li { margin:10px 0; padding:10px; background:#fff; border-radius:8px; box-shadow:0 2px 4px rgba(0,0,0,0.1); }
-.error { color:red; }
-</style>
-</head>
-<body>
-<h1>Image Importer</h1>
-<div class="form-container">
-<h2>Import Images from Google Drive Folder</h2>
-<input type="text" id="url" placeholder="Public Google Drive Folder URL">
-<button onclick="importImages()">Import</button>
-<p id="import-status"></p>
-</div>
-<h2>Imported Images</h2>
-<ul id="image-list" class="image-list"></ul>
-<script>
-async function importImages() {
-const url=document.getElementById('url').value;
-const status=document.getElementById('import-status');
-status.textContent='Importing...';
-try{
-const res=await fetch('/import',{method:'POST',headers:{'Content-Type':'application/json'},body:JSON.stringify({url})});
-const data=await res.json();
-status.textContent=data.message||'Import completed';
-loadImages();
-}catch(err){status.textContent='Error: '+err.message;}
-}
-async function loadImages(){
-const list=document.getElementById('image-list');
-list.innerHTML='';
-try{
-const res=await fetch('/images');
-const images=await res.json();
-if(!images.length){list.innerHTML='<li>No images found.</li>';}
-images.forEach(img=>{
-const li=document.createElement('li');
-li.innerHTML=`<strong>${img.name}</strong><br>Size: ${img.size} bytes, Type: ${img.mime_type}<br><a href="/storage/${img.name}" target="_blank">View Image</a><br><img src="/storage/${img.name}" alt="${img.name}">`;
-list.appendChild(li);
-});
-}catch(err){list.innerHTML=`<li class="error">Error loading images: ${err.message}</li>`;}
-}
-loadImages();
-</script>
-</body>
-</html>
-"""
+INDEX_HTML = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static", "index.html")
 
-@app.get("/", response_class=HTMLResponse)
+@app.get("/")
 async def root():
-    return html_content
+    return FileResponse(INDEX_HTML, media_type="text/html", headers={"Cache-Control": "public, max-age=3600"})
+
+# Local/production entrypoint: uvloop event loop + httptools parser.
+# Import jobs and the listing cache are per process, so keep WEB_CONCURRENCY at 1
+# unless they are moved to a shared store.
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=int(os.environ.get("PORT", 8000)),
+        loop="uvloop",
+        http="httptools",
+        workers=int(os.environ.get("WEB_CONCURRENCY", 1)),
+    )